@@ -1,6 +1,8 @@
+import json
 import os
 import subprocess
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from tqdm import tqdm
 
 # === Paths ===
@@ -13,12 +15,15 @@ os.makedirs(output_folder, exist_ok=True)
 # === FFmpeg path ===
 # Folosește variabila de mediu FFMPEG_PATH dacă e setată, altfel presupune că ffmpeg e în PATH
 ffmpeg_path = os.getenv("FFMPEG_PATH", "ffmpeg")
+ffprobe_path = os.getenv("FFPROBE_PATH", "ffprobe")
 
 # === Get sorted video list ===
-videos = sorted([
-    f for f in os.listdir(input_folder)
-    if f.lower().endswith(('.mp4', '.mov', '.mkv', '.avi'))
-])
+VIDEO_EXTENSIONS = {"mp4", "mov", "mkv", "avi"}
+with os.scandir(input_folder) as it:
+    videos = sorted(
+        e.name for e in it
+        if e.is_file() and e.name.rpartition(".")[2].lower() in VIDEO_EXTENSIONS
+    )
 if not videos:
     raise ValueError("No video files found in the input folder.")
 
@@ -27,16 +32,81 @@ for v in videos:
     print(f"   • {v}")
 
 
-def fast_trim(video_path, output_path, start=None, end=None):
-    """Use ffmpeg to trim or copy video without re-encoding (fast)."""
-    cmd = [ffmpeg_path, "-y", "-hide_banner", "-loglevel", "error", "-i", video_path]
+def to_seconds(timestamp):
+    """Convert an ffmpeg timestamp ("HH:MM:SS", "MM:SS" or seconds) to seconds."""
+    seconds = 0.0
+    for part in str(timestamp).split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def build_trim_cmd(video_path, output_path, start=None, end=None):
+    """Build the ffmpeg command that trims or copies video without re-encoding (fast).
+
+    Seeking is done on the input side so ffmpeg jumps straight to the nearest
+    keyframe instead of demuxing and discarding everything before `start`.
+    """
+    cmd = [ffmpeg_path, "-y", "-hide_banner", "-loglevel", "error"]
     if start is not None:
         cmd += ["-ss", str(start)]
     if end is not None:
-        cmd += ["-to", str(end)]
-    cmd += ["-c", "copy", output_path]
-    subprocess.run(cmd, check=True)
-    return output_path
+        # After an input seek timestamps restart at zero, so use a duration.
+        duration = to_seconds(end) - to_seconds(start or 0)
+        cmd += ["-t", str(duration)]
+    cmd += ["-i", video_path, "-c", "copy", output_path]
+    return cmd
+
+
+SIGNATURE_FIELDS = (
+    "codec_type", "codec_name", "width", "height", "pix_fmt",
+    "time_base", "sample_aspect_ratio", "sample_rate", "channels"
+)
+VIDEO_ENCODERS = {"h264": "libx264", "hevc": "libx265", "vp9": "libvpx-vp9", "av1": "libaom-av1"}
+AUDIO_ENCODERS = {"aac": "aac", "opus": "libopus", "mp3": "libmp3lame"}
+
+
+def probe_signature(video_path):
+    """Return the stream parameters (video and audio) that must match for a concat copy."""
+    cmd = [
+        ffprobe_path, "-v", "error",
+        "-show_entries", "stream=" + ",".join(SIGNATURE_FIELDS),
+        "-of", "json", video_path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    streams = json.loads(result.stdout).get("streams") or []
+    return tuple(
+        tuple(stream.get(k) for k in SIGNATURE_FIELDS)
+        for stream in streams
+        if stream.get("codec_type") in ("video", "audio")
+    )
+
+
+def build_normalize_cmd(video_path, output_path, signature):
+    """Build the ffmpeg command that re-encodes a clip to match `signature`."""
+    streams = [dict(zip(SIGNATURE_FIELDS, stream)) for stream in signature]
+    video = next((st for st in streams if st["codec_type"] == "video"), None)
+    audio = next((st for st in streams if st["codec_type"] == "audio"), None)
+
+    cmd = [ffmpeg_path, "-y", "-hide_banner", "-loglevel", "error", "-i", video_path]
+    if video:
+        filters = [f"scale={video['width']}:{video['height']}"]
+        sar = video.get("sample_aspect_ratio")
+        if sar and sar != "0:1":
+            filters.append(f"setsar={sar.replace(':', '/')}")
+        if video.get("pix_fmt"):
+            filters.append(f"format={video['pix_fmt']}")
+        cmd += ["-map", "0:v:0", "-vf", ",".join(filters),
+                "-c:v", VIDEO_ENCODERS.get(video["codec_name"], video["codec_name"])]
+        # Matching the track timescale is only possible (and only needed) for mp4/mov
+        num, _, den = str(video.get("time_base") or "").partition("/")
+        if num == "1" and den.isdigit() and Path(output_path).suffix.lower() in (".mp4", ".mov"):
+            cmd += ["-video_track_timescale", den]
+    if audio:
+        cmd += ["-map", "0:a:0?",
+                "-c:a", AUDIO_ENCODERS.get(audio["codec_name"], audio["codec_name"]),
+                "-ar", str(audio["sample_rate"]), "-ac", str(audio["channels"])]
+    cmd.append(output_path)
+    return cmd
 
 
 # === Prepare paths ===
@@ -47,53 +117,78 @@ trimmed_last_path = os.path.join(output_folder, f"trimmed_last_{videos[-1]}")
 
 # === Run trimming concurrently ===
 print("\n✂️  Fast trimming first and last videos...")
-with ThreadPoolExecutor(max_workers=2) as executor:
-    futures = {
-        executor.submit(fast_trim, first_video, trimmed_first_path, start="00:03:12"): "First",
-        executor.submit(fast_trim, last_video, trimmed_last_path, end="00:01:12"): "Last"
-    }
-    for _ in tqdm(as_completed(futures), total=len(futures), desc="Trimming progress", unit="video"):
-        pass
+# Both ffmpeg processes are started directly; no Python thread needs to sit on them.
+trim_cmds = [
+    build_trim_cmd(first_video, trimmed_first_path, start="00:03:12"),
+    build_trim_cmd(last_video, trimmed_last_path, end="00:01:12"),
+]
+procs = [
+    (cmd, subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE))
+    for cmd in trim_cmds
+]
+try:
+    for cmd, proc in tqdm(procs, desc="Trimming progress", unit="video"):
+        _, stderr = proc.communicate()
+        if proc.returncode != 0:
+            message = stderr.decode(errors="replace").strip()
+            raise RuntimeError(f"ffmpeg failed trimming {cmd[cmd.index('-i') + 1]}:\n{message}")
+finally:
+    # Don't leave the other trim running if one of them failed
+    for _, proc in procs:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
 
 # === Handle middle videos ===
-middle_outputs = []
-if len(videos) > 2:
-    print("\n🎞️  Copying middle videos...")
-    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-        futures = []
-        for filename in videos[1:-1]:
-            src = os.path.join(input_folder, filename)
-            dst = os.path.join(output_folder, filename)
-            middle_outputs.append(dst)
-            if not os.path.exists(dst):
-                futures.append(executor.submit(fast_trim, src, dst))
-        for _ in tqdm(as_completed(futures), total=len(futures), desc="Copying middle clips", unit="video"):
-            pass
+# Middle clips are used as-is: the concat demuxer reads them straight from the
+# input folder, so copying them first would only duplicate bytes on disk.
+# Paths are stored absolute and in posix form, ready for the concat list.
+middle_outputs = [Path(input_folder, f).absolute().as_posix() for f in videos[1:-1]]
+if middle_outputs:
+    print(f"\n🎞️  Using {len(middle_outputs)} middle video(s) in place.")
 else:
-    print("\n⚠️  Only two videos found (no middle videos to copy).")
+    print("\n⚠️  Only two videos found (no middle videos to add).")
+
+all_paths = [
+    Path(trimmed_first_path).absolute().as_posix(),
+    *middle_outputs,
+    Path(trimmed_last_path).absolute().as_posix(),
+]
+
+# === Check that all clips can be stream-copied together ===
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+    signatures = list(executor.map(probe_signature, all_paths))
+
+# The concat demuxer takes its stream parameters from the first clip, so every
+# clip that differs is re-encoded once to match it; the join itself stays a copy.
+reference = signatures[0]
+outliers = [i for i, sig in enumerate(signatures) if sig != reference]
+if outliers:
+    print(f"\n⚠️  {len(outliers)} clip(s) have different stream parameters, normalizing them...")
+    extension = Path(all_paths[0]).suffix
+    for i in tqdm(outliers, desc="Normalizing clips", unit="video"):
+        normalized = Path(output_folder, f"normalized_{i}_{Path(all_paths[i]).stem}{extension}")
+        subprocess.run(build_normalize_cmd(all_paths[i], str(normalized), reference), check=True)
+        all_paths[i] = normalized.absolute().as_posix()
 
 # === Combine all clips using FFmpeg concat (instant) ===
 print("\n🎬 Combining all clips (no re-encode)...")
 
-concat_list_path = os.path.join(output_folder, "concat_list.txt")
-with open(concat_list_path, "w", encoding="utf-8") as f:
-    # Add trimmed first
-    f.write(f"file '{trimmed_first_path.replace('\\', '/')}'\n")
-    # Add middle ones
-    for path in middle_outputs:
-        f.write(f"file '{path.replace('\\', '/')}'\n")
-    # Add trimmed last
-    f.write(f"file '{trimmed_last_path.replace('\\', '/')}'\n")
+# The concat list is fed to ffmpeg over stdin, so no list file is left behind.
+list_bytes = b"".join(
+    b"file '%s'\n" % path.encode("utf-8") for path in all_paths
+)
 
 final_output = os.path.join(output_folder, "final_combined_video.mp4")
 
 cmd_concat = [
     ffmpeg_path, "-y", "-hide_banner", "-loglevel", "error",
-    "-f", "concat", "-safe", "0",
-    "-i", concat_list_path,
-    "-c", "copy", final_output
+    "-f", "concat", "-safe", "0", "-protocol_whitelist", "file,pipe",
+    "-fflags", "+genpts",
+    "-i", "-",
+    "-c", "copy", "-avoid_negative_ts", "make_zero", final_output
 ]
 
-subprocess.run(cmd_concat, check=True)
+subprocess.run(cmd_concat, input=list_bytes, check=True)
 
 print(f"\n✅ Final combined video saved to:\n{final_output}")
@@ -11,12 +11,17 @@ Dependencies:
     pip install yt-dlp moviepy==1.0.3 librosa numpy<2 tqdm
 """
 
+import json
 import os
+import queue
 import subprocess
+import threading
+from contextlib import ExitStack, closing
+from pathlib import Path
 import numpy as np
 import librosa
 from moviepy.editor import VideoFileClip, concatenate_videoclips
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 # === CONFIGURATION ===
@@ -25,14 +30,16 @@ OUTPUT_FOLDER = os.getenv("OUTPUT_FOLDER", "output")
 TEMP_FOLDER = os.getenv("TEMP_FOLDER", "temp")
 COMBINED_OUTPUT = os.getenv("COMBINED_OUTPUT", os.path.join(OUTPUT_FOLDER, "combined_highlights.mp4"))
 FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")  # assume ffmpeg is in PATH
+FFPROBE_PATH = os.getenv("FFPROBE_PATH", "ffprobe")  # assume ffprobe is in PATH
 
-AUDIO_FPS = 48000
+AUDIO_FPS = 11025  # onset clusters do not need more; hop 1024 ≈ 93 ms
 THRESHOLD_PERCENTILE = 99.9
 PRE_SECONDS = 5
 POST_SECONDS = 5
 MIN_GAP_BETWEEN_EVENTS = 10
 SEGMENT_DURATION = 300  # seconds
-MAX_WORKERS = 12  # Optimized for 6C/12T CPUs
+NETWORK_WORKERS = int(os.getenv("NETWORK_WORKERS", "6"))  # concurrent yt-dlp downloads (Twitch caps per-IP connections)
+CPU_WORKERS = os.cpu_count() or 1  # local ffmpeg jobs
 
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 os.makedirs(TEMP_FOLDER, exist_ok=True)
@@ -59,42 +66,59 @@ def save_video(clip, path):
 
 
 # === AUDIO DETECTION ===
+def _load_audio_pcm(path, sr=AUDIO_FPS):
+    """Decode the audio track to mono 16-bit PCM via an ffmpeg pipe (skips video decode)."""
+    cmd = [
+        FFMPEG_PATH, "-v", "error",
+        "-i", path,
+        "-vn", "-ac", "1", "-ar", str(sr),
+        "-f", "s16le", "-"
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    raw, err = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(err.decode(errors="replace").strip() or f"ffmpeg exited with {proc.returncode}")
+    y = np.frombuffer(raw, dtype=np.int16).astype(np.float32) / 32768.0
+    return y, sr
+
+
 def detect_loud_sections(local_file):
     """Detect intense action periods (e.g., gunshots) in a video file."""
     log(f"Analyzing audio: {local_file}", "🎧")
     try:
-        y, sr = librosa.load(local_file, sr=AUDIO_FPS)
+        y, sr = _load_audio_pcm(local_file)
     except Exception as e:
         log(f"Error loading audio from {local_file}: {e}", "❌")
         return []
 
+    # One magnitude spectrogram shared by onset strength and spectral centroid
+    S = np.abs(librosa.stft(y, n_fft=2048, hop_length=1024)).astype(np.float32)
+
     # Onset detection
-    onset_env = librosa.onset.onset_strength(y=y, sr=sr, hop_length=1024)
+    onset_env = librosa.onset.onset_strength(S=librosa.power_to_db(S**2), sr=sr, n_fft=2048, hop_length=1024)
     onset_frames = librosa.onset.onset_detect(onset_envelope=onset_env, sr=sr, units="frames")
     onset_times_all = librosa.frames_to_time(onset_frames, sr=sr)
 
     # Filter onsets by strength and frequency (detect sharp high-frequency bursts)
     strength_threshold = np.percentile(onset_env, 95)
-    spectral_centroid = librosa.feature.spectral_centroid(y=y, sr=sr, hop_length=1024)[0]
-    centroid_threshold = 4000  # Hz
-    filtered_onsets = [
-        t for t, f in zip(onset_times_all, onset_frames)
-        if onset_env[f] > strength_threshold and spectral_centroid[f] > centroid_threshold
-    ]
+    spectral_centroid = librosa.feature.spectral_centroid(S=S, sr=sr)[0]
+    centroid_threshold = 3500  # Hz (Nyquist is AUDIO_FPS / 2)
+    mask = (onset_env[onset_frames] > strength_threshold) & (spectral_centroid[onset_frames] > centroid_threshold)
+    filtered_onsets = onset_times_all[mask]
 
     # Detect clusters of onsets (action peaks)
     window_size = 15.0
     step_size = 5.0
     min_onsets = 6
-    events = []
-    max_time = filtered_onsets[-1] if filtered_onsets else 0
+    ot = np.sort(filtered_onsets)
+    max_time = ot[-1] if len(ot) else 0
 
-    for window_start in np.arange(0, max_time - window_size + step_size, step_size):
-        window_end = window_start + window_size
-        onsets_in_window = [t for t in filtered_onsets if window_start <= t < window_end]
-        if len(onsets_in_window) >= min_onsets:
-            center_time = (window_start + window_end) / 2
-            events.append(center_time)
+    # Count onsets in every [start, start + window_size) window at once
+    starts = np.arange(0, max_time - window_size + step_size, step_size)
+    left = np.searchsorted(ot, starts)
+    right = np.searchsorted(ot, starts + window_size)
+    counts = right - left
+    events = (starts[counts >= min_onsets] + window_size / 2).tolist()
 
     # Filter events by minimum time gap
     filtered_events = []
@@ -123,66 +147,194 @@ def download_segment(vod_url, start, end, output_path):
     return output_path
 
 
-# === PROCESS VOD ===
-def process_vod(vod_url, vod_index):
-    log(f"Processing VOD: {vod_url}", "🎬")
+def download_sections(vod_url, sections, output_template):
+    """Download several time sections of a Twitch VOD with a single yt-dlp call.
+
+    `output_template` should contain `%(section_start)d` so each section gets its own file.
+    """
+    cmd = ["yt-dlp", "--ffmpeg-location", FFMPEG_PATH, "-f", "best"]
+    for start, end in sections:
+        cmd += ["--download-sections", f"*{start}-{end}"]
+    cmd += [vod_url, "-o", output_template]
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    log(f"{len(sections)} section(s) downloaded: {output_template}", "✅")
+
+
+def local_trim(source_path, start, end, output_path):
+    """Cut [start, end] out of an already downloaded file without re-encoding."""
+    cmd = [
+        FFMPEG_PATH, "-y", "-hide_banner", "-loglevel", "error",
+        "-ss", str(start), "-to", str(end),
+        "-i", source_path,
+        "-c", "copy", "-avoid_negative_ts", "make_zero",
+        output_path
+    ]
+    subprocess.run(cmd, check=True)
+    log(f"Highlight saved: {output_path}", "✅")
+    return output_path
+
 
-    # Get VOD duration
+# === PROCESS VOD ===
+def get_vod_duration(vod_url):
+    """Return the VOD duration in whole seconds from a single yt-dlp metadata request."""
     result = subprocess.run(
-        ["yt-dlp", "--ffmpeg-location", FFMPEG_PATH, "--get-duration", vod_url],
-        capture_output=True, text=True
+        ["yt-dlp", "--ffmpeg-location", FFMPEG_PATH, "--print", "%(duration)s", vod_url],
+        capture_output=True, text=True, check=True
     )
-    duration_str = result.stdout.strip()
-    parts = list(map(int, duration_str.split(":")))
-    if len(parts) == 3:
-        h, m, s = parts
-    elif len(parts) == 2:
-        h, m, s = 0, parts[0], parts[1]
-    else:
-        h, m, s = 0, 0, parts[0]
-    vod_duration = h * 3600 + m * 60 + s
+    return int(float(result.stdout.strip().splitlines()[0]))
+
+
+def process_vod(vod_url, vod_index):
+    log(f"Processing VOD: {vod_url}", "🎬")
 
-    # Split into chunks
-    vod_segments = [(i, min(i + SEGMENT_DURATION, vod_duration)) for i in range(0, vod_duration, SEGMENT_DURATION)]
     highlight_paths = []
 
-    def process_segment_wrapper(start, end, seg_idx):
-        temp_file = os.path.join(TEMP_FOLDER, f"vod{vod_index}_seg{seg_idx}.mp4")
-        if not os.path.exists(temp_file):
-            download_segment(vod_url, start, end, temp_file)
+    # Snapshot existing files once instead of stat-ing every path
+    existing_temp = set(os.listdir(TEMP_FOLDER))
+    existing_output = set(os.listdir(OUTPUT_FOLDER))
 
-        try:
-            events = detect_loud_sections(temp_file)
-        except Exception as e:
-            log(f"Skipping segment {seg_idx} due to error: {e}", "⚠️")
-            return []
+    def fetch_segment(start, end, seg_idx):
+        filename = f"vod{vod_index}_seg{seg_idx}.mp4"
+        temp_file = os.path.join(TEMP_FOLDER, filename)
+        if filename not in existing_temp:
+            download_segment(vod_url, start, end, temp_file)
+        return temp_file
 
-        segment_clips = []
+    def cut_highlights(temp_file, events, seg_idx, seg_start, download_pool):
+        segment_clips = {}
+        failed = []
         for i, (s, e) in enumerate(events):
-            highlight_file = os.path.join(OUTPUT_FOLDER, f"vod{vod_index}_seg{seg_idx}_{i}.mp4")
-            if not os.path.exists(highlight_file):
+            filename = f"vod{vod_index}_seg{seg_idx}_{i}.mp4"
+            highlight_file = os.path.join(OUTPUT_FOLDER, filename)
+            if filename not in existing_output:
+                try:
+                    local_trim(temp_file, s, e, highlight_file)
+                    segment_clips[i] = highlight_file
+                except Exception as err:
+                    log(f"Error cutting highlight ({s}-{e}): {err}", "❌")
+                    failed.append((i, int(seg_start + s), int(seg_start + e)))
+
+        # Fallback: fetch every highlight that could not be cut locally from the
+        # VOD in one yt-dlp call, instead of paying manifest resolution per clip.
+        # It goes through download_pool so it counts against NETWORK_WORKERS.
+        if failed:
+            template = os.path.join(OUTPUT_FOLDER, f"vod{vod_index}_seg{seg_idx}_at%(section_start)d.mp4")
+            try:
+                download_pool.submit(
+                    download_sections, vod_url, [(s, e) for _, s, e in failed], template
+                ).result()
+            except Exception as err:
+                log(f"Error downloading highlights for segment {seg_idx}: {err}", "❌")
+            for i, s, e in failed:
+                downloaded = os.path.join(OUTPUT_FOLDER, f"vod{vod_index}_seg{seg_idx}_at{s}.mp4")
+                if os.path.exists(downloaded):
+                    highlight_file = os.path.join(OUTPUT_FOLDER, f"vod{vod_index}_seg{seg_idx}_{i}.mp4")
+                    os.replace(downloaded, highlight_file)
+                    segment_clips[i] = highlight_file
+                else:
+                    log(f"Highlight ({s}-{e}) was not downloaded.", "❌")
+        return [segment_clips[i] for i in sorted(segment_clips)]
+
+    # Pipeline: downloads are prefetched while the main thread analyzes audio,
+    # and highlight cuts run in the background. The bounded queue keeps at most
+    # one batch of downloads ahead of the analysis.
+    segment_queue = queue.Queue(maxsize=NETWORK_WORKERS)
+
+    def reader(download_pool, vod_segments, first_download):
+        for idx, (s, e) in enumerate(vod_segments):
+            if idx == 0:
+                segment_queue.put((idx, first_download))
+            else:
+                segment_queue.put((idx, download_pool.submit(fetch_segment, s, e, idx)))
+        segment_queue.put(None)
+
+    # The first segment always starts at 0, so start downloading it while
+    # the VOD duration is still being resolved.
+    download_pool = ThreadPoolExecutor(max_workers=NETWORK_WORKERS)
+    duration_future = download_pool.submit(get_vod_duration, vod_url)
+    first_download = download_pool.submit(fetch_segment, 0, SEGMENT_DURATION, 0)
+    try:
+        vod_duration = duration_future.result()
+    except Exception:
+        # Report a bad VOD right away instead of waiting for the first segment
+        download_pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+    # Split into chunks
+    vod_segments = [(i, min(i + SEGMENT_DURATION, vod_duration)) for i in range(0, vod_duration, SEGMENT_DURATION)]
+
+    writes = {}
+    with download_pool, ThreadPoolExecutor(max_workers=CPU_WORKERS) as writer_pool:
+        threading.Thread(
+            target=reader, args=(download_pool, vod_segments, first_download), daemon=True
+        ).start()
+        with tqdm(total=len(vod_segments), desc="Processing segments") as progress:
+            while (item := segment_queue.get()) is not None:
+                idx, download = item
+                progress.update(1)
+                try:
+                    temp_file = download.result()
+                except Exception as e:
+                    log(f"Error in segment {idx}: {e}", "❌")
+                    continue
                 try:
-                    download_segment(vod_url, int(start + s), int(start + e), highlight_file)
-                    segment_clips.append(highlight_file)
+                    events = detect_loud_sections(temp_file)
                 except Exception as e:
-                    log(f"Error downloading highlight ({s}-{e}): {e}", "❌")
-        return segment_clips
-
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {
-            executor.submit(process_segment_wrapper, s, e, idx): idx
-            for idx, (s, e) in enumerate(vod_segments)
-        }
-        for f in tqdm(as_completed(futures), total=len(futures), desc="Processing segments"):
+                    log(f"Skipping segment {idx} due to error: {e}", "⚠️")
+                    continue
+                writes[idx] = writer_pool.submit(
+                    cut_highlights, temp_file, events, idx, vod_segments[idx][0], download_pool
+                )
+
+        for idx in sorted(writes):
             try:
-                highlight_paths.extend(f.result())
+                highlight_paths.extend(writes[idx].result())
             except Exception as e:
-                idx = futures[f]
                 log(f"Error in segment {idx}: {e}", "❌")
 
     return highlight_paths
 
 
+# === COMBINE HIGHLIGHTS ===
+SIGNATURE_FIELDS = (
+    "codec_type", "codec_name", "width", "height", "pix_fmt",
+    "time_base", "sample_aspect_ratio", "sample_rate", "channels"
+)
+
+
+def probe_signature(path):
+    """Return the stream parameters (video and audio) that must match for a concat copy."""
+    cmd = [
+        FFPROBE_PATH, "-v", "error",
+        "-show_entries", "stream=" + ",".join(SIGNATURE_FIELDS),
+        "-of", "json",
+        path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    streams = json.loads(result.stdout).get("streams") or []
+    return tuple(
+        tuple(stream.get(k) for k in SIGNATURE_FIELDS)
+        for stream in streams
+        if stream.get("codec_type") in ("video", "audio")
+    )
+
+
+def concat_highlights(paths, output_path):
+    """Join clips with the ffmpeg concat demuxer (no re-encode)."""
+    list_path = os.path.join(TEMP_FOLDER, "highlights_list.txt")
+    posix_paths = [Path(p).absolute().as_posix() for p in paths]
+    with open(list_path, "w", encoding="utf-8") as f:
+        f.writelines(f"file '{p}'\n" for p in posix_paths)
+    cmd = [
+        FFMPEG_PATH, "-y", "-hide_banner", "-loglevel", "error",
+        "-f", "concat", "-safe", "0",
+        "-i", list_path,
+        "-c", "copy", output_path
+    ]
+    subprocess.run(cmd, check=True)
+    return output_path
+
+
 # === MAIN ===
 def main():
     log("Starting Hunt: Showdown highlight extractor...", "🎬")
@@ -202,11 +354,16 @@ def main():
 
     if all_highlights:
         log("Combining all highlights...", "🔗")
-        clips = [VideoFileClip(p) for p in all_highlights]
-        combined = concatenate_videoclips(clips, method="compose")
-        save_video(combined, COMBINED_OUTPUT)
-        for c in clips:
-            c.close()
+        with ThreadPoolExecutor(max_workers=CPU_WORKERS) as executor:
+            signatures = set(executor.map(probe_signature, all_highlights))
+        if len(signatures) == 1:
+            concat_highlights(all_highlights, COMBINED_OUTPUT)
+        else:
+            log("Highlights have mismatched streams, re-encoding with MoviePy.", "⚠️")
+            with ExitStack() as stack:
+                clips = (stack.enter_context(closing(VideoFileClip(p))) for p in all_highlights)
+                combined = concatenate_videoclips(list(clips), method="compose")
+                save_video(combined, COMBINED_OUTPUT)
         log(f"✅ Done! Combined highlights saved to:\n{COMBINED_OUTPUT}", "🏁")
     else:
         log("No highlights were generated.", "⚠️")